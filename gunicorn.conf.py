@@ -0,0 +1,16 @@
+import multiprocessing
+import os
+
+# Threaded workers by default, so a request blocked on the Spotify API doesn't
+# hold up the whole worker. Set gunicorn_worker_class=gevent to use greenlets;
+# don't pass -k/--worker-class instead, since preload_app below is decided
+# here and can't see command-line overrides.
+worker_class = os.getenv('gunicorn_worker_class', 'gthread')
+workers = int(os.getenv('gunicorn_workers', multiprocessing.cpu_count() * 2 + 1))
+threads = 4
+worker_connections = 500
+
+# Import the app (sentiment lexicon, compiled regexes and templates) once in
+# the master and share it with the forked workers. gevent has to patch the
+# standard library before the app is imported, so it can't be preloaded.
+preload_app = worker_class != 'gevent'
@@ -1,11 +1,27 @@
 import os
-import json
+import functools
+import hashlib
+import heapq
+import logging
 import random
 import re
+import secrets
+import time
+import orjson
+import redis
+import requests
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
+from itertools import chain
+from types import MappingProxyType
 from dotenv import load_dotenv
-from flask import Flask, session, redirect, url_for, request, render_template, jsonify
+from flask import Flask, g, session, redirect, url_for, request, render_template, jsonify, copy_current_request_context
+from flask.json.provider import DefaultJSONProvider
+from flask_caching import Cache
 from flask_session import Session
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 from spotipy import Spotify
 from spotipy.oauth2 import SpotifyOAuth
@@ -13,6 +29,16 @@ from spotipy.cache_handler import FlaskSessionCacheHandler
 
 # Simple sentiment analysis without external dependencies
 class SimpleSentimentAnalyzer:
+    TOKEN_RE = re.compile(r'\b\w+\b')
+    
+    # Phrases that nudge a mood; the group name is the mood they count for
+    CONTEXT_RE = re.compile(
+        r'(?P<happy>feel(?:ing)? good)'
+        r'|(?P<sad>feel(?:ing)? bad)'
+        r'|(?P<energetic>(?:need|want) energy)'
+        r'|(?P<chill>want to relax|need to chill)'
+    )
+    
     def __init__(self):
         self.positive_words = {
             'happy', 'joy', 'excited', 'amazing', 'great', 'fantastic', 'wonderful', 'awesome',
@@ -44,123 +70,320 @@ class SimpleSentimentAnalyzer:
             'mellow', 'flowing', 'cruising', 'cozy', 'comfortable', 'easygoing',
             'lowkey', 'ambient', 'dreamy', 'floating', 'drifting'
         }
+        
+        # Merge the word lists into one lookup so each token costs a single
+        # dict probe. Words listed under several moods ('energetic', 'pumped',
+        # 'relaxed', 'mellow') count for the last mood below.
+        self.moods = ('happy', 'sad', 'calm', 'energetic', 'chill')
+        self.word_to_mood = {}
+        for mood, mood_words in zip(self.moods, (self.positive_words, self.negative_words,
+                                                 self.calm_words, self.energetic_words,
+                                                 self.chill_words)):
+            self.word_to_mood.update(dict.fromkeys(mood_words, mood))
     
     def analyze_sentiment(self, text):
         text = text.lower()
-        words = re.findall(r'\b\w+\b', text)
+        words = self.TOKEN_RE.findall(text)
         
-        scores = {
-            'happy': 0,
-            'sad': 0,
-            'calm': 0,
-            'energetic': 0,
-            'chill': 0
-        }
+        # Seeded in mood order so ties resolve to the earlier mood
+        scores = Counter(dict.fromkeys(self.moods, 0))
         
-        for word in words:
-            if word in self.positive_words:
-                scores['happy'] += 2
-            if word in self.negative_words:
-                scores['sad'] += 2
-            if word in self.calm_words:
-                scores['calm'] += 2
-            if word in self.energetic_words:
-                scores['energetic'] += 2
-            if word in self.chill_words:
-                scores['chill'] += 2
+        # map/filter run the lexicon lookups in C; Python only sees the hits
+        for mood in filter(None, map(self.word_to_mood.get, words)):
+            scores[mood] += 2
         
-        # Add context-based scoring
-        if 'feel good' in text or 'feeling good' in text:
-            scores['happy'] += 1
-        if 'feel bad' in text or 'feeling bad' in text:
-            scores['sad'] += 1
-        if 'need energy' in text or 'want energy' in text:
-            scores['energetic'] += 1
-        if 'want to relax' in text or 'need to chill' in text:
-            scores['chill'] += 1
+        # Add context-based scoring, at most once per mood
+        for mood in {match.lastgroup for match in self.CONTEXT_RE.finditer(text)}:
+            scores[mood] += 1
         
-        # Return the mood with highest score, default to 'happy' if tie
-        max_score = max(scores.values())
+        # Return the mood with highest score, first in mood order on a tie
+        mood, max_score = scores.most_common(1)[0]
         if max_score == 0:
             return 'happy'  # Default mood if no keywords found
         
-        for mood, score in scores.items():
-            if score == max_score:
-                return mood
-        
-        return 'happy'
+        return mood
 
 load_dotenv()
 
+# Debug messages use lazy %-formatting, so they cost almost nothing unless enabled
+logging.basicConfig(level=os.getenv('log_level', 'INFO').upper())
+logger = logging.getLogger(__name__)
+
 client_id = os.getenv('client_id')
 client_secret = os.getenv('client_secret')
 redirect_uri = os.getenv('redirect_uri')
 scope = os.getenv('scope')
+redis_url = os.getenv('redis_url', 'redis://localhost:6379/0')
 
 if not all([client_id, client_secret, redirect_uri, scope]):
     raise ValueError('Missing environment variables! Check your .env file.')
 
+class OrjsonJSONProvider(DefaultJSONProvider):
+    """Flask JSON provider that serializes with orjson."""
+    
+    def dumps(self, obj, **kwargs):
+        option = orjson.OPT_SORT_KEYS if self.sort_keys else 0
+        return orjson.dumps(obj, default=self.default, option=option).decode()
+    
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
 app = Flask(__name__)
+app.json = OrjsonJSONProvider(app)
+
+def load_secret_key(path):
+    """Get the Flask secret key from the environment, or from a key file created on first run."""
+    env_key = os.getenv('secret_key')
+    if env_key:
+        return env_key
+    
+    try:
+        if not os.path.exists(path):
+            # Write to a private temp file and hard-link it into place, so workers
+            # starting at the same time all end up reading the same key
+            tmp_path = f'{path}.{os.getpid()}'
+            fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'wb') as f:
+                f.write(secrets.token_bytes(64))
+            try:
+                os.link(tmp_path, path)
+            except FileExistsError:
+                pass
+            finally:
+                os.unlink(tmp_path)
+        
+        with open(path, 'rb') as f:
+            return f.read()
+    except OSError as e:
+        # e.g. a read-only app directory or a filesystem without hard links
+        logger.warning(
+            "Could not read or create %s (%s); using a per-process secret key. "
+            "Set secret_key so sessions survive restarts and work across workers.", path, e
+        )
+        return secrets.token_bytes(64)
 
-# Configure Flask-Session
-app.config['SECRET_KEY'] = os.urandom(64)
-app.config['SESSION_TYPE'] = 'filesystem'
+# Configure Flask-Session (sessions live in Redis, shared across workers)
+# A stable key keeps sessions valid across restarts and between workers
+app.config['SECRET_KEY'] = load_secret_key(os.path.join(app.root_path, '.flask_secret_key'))
+app.config['SESSION_TYPE'] = 'redis'
+redis_client = redis.from_url(redis_url, socket_keepalive=True)
+app.config['SESSION_REDIS'] = redis_client
 Session(app)
 
+# Server-side cache for Spotify responses that are the same for every user
+cache = Cache(app, config={
+    'CACHE_TYPE': 'RedisCache',
+    'CACHE_REDIS_URL': redis_url,
+    'CACHE_KEY_PREFIX': 'moodify_',
+    'CACHE_DEFAULT_TIMEOUT': 600,
+})
+
+# Compile templates once at startup instead of re-checking them per request
+app.config['TEMPLATES_AUTO_RELOAD'] = False
+for template_name in ('index.html', 'playlist.html'):
+    app.jinja_env.get_template(template_name)
+
 # Initialize sentiment analyzer
 sentiment_analyzer = SimpleSentimentAnalyzer()
 
 # Spotipy Cache Handler
 cache_handler = FlaskSessionCacheHandler(session)
 
-# Spotify OAuth setup
-sp_oauth = SpotifyOAuth(
-    client_id=client_id,
-    client_secret=client_secret,
-    redirect_uri=redirect_uri,
-    scope=scope,
-    cache_handler=cache_handler,
-    show_dialog=True,
-)
+class OrjsonResponse(requests.Response):
+    """Response that decodes its JSON body with orjson."""
+    
+    def json(self, **kwargs):
+        return orjson.loads(self.content)
+
+class SpotifyHTTPAdapter(HTTPAdapter):
+    """HTTPAdapter whose responses parse Spotify's large JSON payloads with orjson."""
+    
+    def build_response(self, req, resp):
+        response = super().build_response(req, resp)
+        response.__class__ = OrjsonResponse
+        return response
+
+@functools.lru_cache(maxsize=1)
+def get_spotify_oauth():
+    """Spotify OAuth setup, built once per process on first use."""
+    return SpotifyOAuth(
+        client_id=client_id,
+        client_secret=client_secret,
+        redirect_uri=redirect_uri,
+        scope=scope,
+        cache_handler=cache_handler,
+        show_dialog=True,
+    )
+
+@functools.lru_cache(maxsize=1)
+def get_spotify():
+    """Spotify client, built once per process on first use."""
+    # Shared HTTP session so keep-alive connections to api.spotify.com are
+    # reused across requests instead of paying a new TLS handshake each time.
+    # Building it lazily means each forked worker gets its own pool.
+    spotify_session = requests.Session()
+    spotify_session.headers['Connection'] = 'keep-alive'
+    spotify_session.mount('https://', SpotifyHTTPAdapter(
+        pool_connections=20,
+        pool_maxsize=100,
+        max_retries=Retry(
+            total=3,
+            read=False,
+            allowed_methods=frozenset(['GET', 'POST', 'PUT', 'DELETE']),
+            status_forcelist=Spotify.default_retry_codes,
+            backoff_factor=0.3,
+        ),
+    ))
+    
+    return Spotify(auth_manager=get_spotify_oauth(), requests_session=spotify_session)
+
+# Tokens with more than this many seconds left are trusted without revalidation
+TOKEN_FRESH_SECONDS = 300
+
+@app.before_request
+def load_cached_token():
+    """Read the cached Spotify token from the session once per request."""
+    g.token_info = cache_handler.get_cached_token()
+
+def get_valid_token():
+    """Return the validated token for this request, or None if the user must log in."""
+    if 'valid_token' not in g:
+        token_info = g.token_info
+        if token_info and token_info.get('expires_at', 0) - time.time() > TOKEN_FRESH_SECONDS:
+            # Clearly not about to expire, so skip spotipy's validation path
+            g.valid_token = token_info
+        else:
+            # validate_token returns the (possibly refreshed) token, or None
+            g.valid_token = get_spotify_oauth().validate_token(token_info)
+            if g.valid_token:
+                g.token_info = g.valid_token
+    return g.valid_token
+
+# Search results and playlist contents barely change minute to minute, and
+# neither depends on the user, so share them across requests for a while
+@cache.memoize(timeout=600)
+def cached_search(q, type='track', limit=10, market=None, offset=0):
+    """Spotify search, memoized on its arguments."""
+    return get_spotify().search(q=q, type=type, limit=limit, market=market, offset=offset)
+
+@cache.memoize(timeout=600)
+def cached_playlist_tracks(playlist_id, limit=100):
+    """Spotify playlist tracks, memoized on its arguments."""
+    return get_spotify().playlist_tracks(playlist_id, limit=limit)
+
+# Shared pool for issuing independent Spotify calls concurrently. A playlist
+# generation fans out to about a dozen calls, so size it for at least one
+# request's first wave.
+spotify_executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix='spotify')
 
-sp = Spotify(auth_manager=sp_oauth)
+def submit_in_request_context(fn, *args, **kwargs):
+    """Submit a Spotify call to the shared pool with access to the current request's session."""
+    # spotipy reads the token through FlaskSessionCacheHandler, so worker
+    # threads need their own copy of the request context
+    return spotify_executor.submit(copy_current_request_context(fn), *args, **kwargs)
+
+MOODS = ('happy', 'energetic', 'chill', 'sad', 'calm')
+
+# Seconds to reuse a user's top tracks before asking Spotify again
+TOP_TRACKS_TTL = 3600
+
+# Unique candidates to gather before choosing a playlist from them; enough
+# headroom for the top-30 selection to still vary between refreshes
+CANDIDATE_POOL_SIZE = 60
+
+# Recently generated tracks remembered per user and mood, and for how long
+TRACK_CACHE_SIZE = 100
+TRACK_CACHE_TTL = 86400
 
 # Store previously generated tracks to avoid repetition
 def get_user_cache_key():
     """Generate a unique cache key for the current user"""
-    token_info = cache_handler.get_cached_token()
-    if token_info and 'access_token' in token_info:
-        # Use a hash of the access token for user identification
-        return f"user_{abs(hash(token_info['access_token']))}"
-    return "anonymous"
+    if 'user_cache_key' not in g:
+        token_info = g.token_info
+        if 'user_id' in session:
+            # The Spotify user ID survives token refreshes and restarts
+            g.user_cache_key = f"user_{session['user_id']}"
+        elif token_info and 'access_token' in token_info:
+            # Use a stable hash of the access token for user identification
+            # (the built-in hash() is randomized per process)
+            digest = hashlib.blake2b(token_info['access_token'].encode(), digest_size=8).hexdigest()
+            g.user_cache_key = f"token_{digest}"
+        else:
+            g.user_cache_key = "anonymous"
+    return g.user_cache_key
 
 def get_cached_tracks(mood):
-    """Get previously generated tracks for this user and mood"""
-    cache_key = get_user_cache_key()
-    user_cache = session.get(f'track_cache_{cache_key}', {})
-    return user_cache.get(mood, [])
+    """Get previously generated tracks for this user and mood, as a set for fast lookups"""
+    key = f'track_cache:{get_user_cache_key()}:{mood}'
+    return frozenset(track_id.decode() for track_id in redis_client.lrange(key, 0, -1))
 
 def cache_tracks(mood, track_ids):
     """Cache generated tracks for this user and mood"""
-    cache_key = get_user_cache_key()
-    user_cache = session.get(f'track_cache_{cache_key}', {})
+    if not track_ids:
+        return
+    
+    # Stored as a capped Redis list outside the session, so it isn't
+    # re-pickled on every request and expires on its own
+    key = f'track_cache:{get_user_cache_key()}:{mood}'
+    with redis_client.pipeline() as pipe:
+        # Move re-generated tracks to the end rather than storing them twice
+        for track_id in track_ids:
+            pipe.lrem(key, 0, track_id)
+        pipe.rpush(key, *track_ids)
+        # Keep only the last 100 tracks per mood
+        pipe.ltrim(key, -TRACK_CACHE_SIZE, -1)
+        pipe.expire(key, TRACK_CACHE_TTL)
+        pipe.execute()
+
+def get_current_user_id():
+    """Get the Spotify user ID, looked up once per session"""
+    if 'user_id' not in session:
+        session['user_id'] = get_spotify().current_user()['id']
+    return session['user_id']
+
+def get_user_top_track_ids():
+    """Get the user's popular top track IDs, cached in the session for an hour"""
+    # Top tracks drift over days, so refreshing a playlist shouldn't refetch them
+    if time.time() - session.get('top_tracks_ts', 0) < TOP_TRACKS_TTL and 'top_track_ids' in session:
+        return session['top_track_ids']
     
-    # Keep only last 100 tracks per mood to prevent session bloat
-    if mood not in user_cache:
-        user_cache[mood] = []
+    sp = get_spotify()
+    time_ranges = ['short_term', 'medium_term', 'long_term']
+    user_top_tracks = set()
+    fetch_failed = False
     
-    user_cache[mood].extend(track_ids)
-    user_cache[mood] = list(set(user_cache[mood]))[-100:]  # Remove duplicates and limit
+    # Get more tracks and filter by popularity, all time ranges at once
+    top_track_futures = {
+        time_range: submit_in_request_context(sp.current_user_top_tracks, limit=25, time_range=time_range)
+        for time_range in time_ranges
+    }
+    
+    for time_range, future in top_track_futures.items():
+        try:
+            top_tracks = future.result()
+            if top_tracks and top_tracks['items']:
+                # Filter for popular tracks (popularity > 60)
+                user_top_tracks.update(track['id'] for track in top_tracks['items'] 
+                                       if track.get('popularity', 0) > 60)
+        except Exception as e:
+            fetch_failed = True
+            logger.warning("Error getting %s top tracks: %s", time_range, e)
     
-    session[f'track_cache_{cache_key}`'] = user_cache
+    # Stored as a list, which is what the session serializer round-trips
+    user_top_tracks = list(user_top_tracks)
+    
+    # Don't pin a partial result for an hour if Spotify had a hiccup
+    if not fetch_failed:
+        session['top_track_ids'] = user_top_tracks
+        session['top_tracks_ts'] = time.time()
+    
+    return user_top_tracks
 
 @app.route('/')
 def home():
     """Main route that checks for a valid Spotify token."""
-    token_info = cache_handler.get_cached_token()
-    
-    if not sp_oauth.validate_token(token_info):
-        auth_url = sp_oauth.get_authorize_url()
+    if not get_valid_token():
+        auth_url = get_spotify_oauth().get_authorize_url()
         return redirect(auth_url)
     
     return render_template('index.html')
@@ -168,16 +391,25 @@ def home():
 @app.route('/callback')
 def callback():
     """Callback route after Spotify authentication."""
-    sp_oauth.get_access_token(request.args.get('code'))
+    get_spotify_oauth().get_access_token(request.args.get('code'))
+    
+    # Drop anything cached for whoever was logged in to this session before
+    for key in ('user_id', 'top_track_ids', 'top_tracks_ts'):
+        session.pop(key, None)
+    
+    try:
+        get_current_user_id()
+    except Exception as e:
+        # Not fatal; create_spotify_playlist looks it up again if needed
+        logger.warning("Error getting current user: %s", e)
+    
     return redirect(url_for('home'))
 
 @app.route('/generate_playlist', methods=['GET', 'POST'])
 def generate_playlist():
     """Generate playlist from mood selection or text description."""
-    token_info = cache_handler.get_cached_token()
-    
-    if not sp_oauth.validate_token(token_info):
-        return redirect(sp_oauth.get_authorize_url())
+    if not get_valid_token():
+        return redirect(get_spotify_oauth().get_authorize_url())
     
     if request.method == 'POST':
         # Check if it's a mood selection or text description
@@ -187,7 +419,7 @@ def generate_playlist():
         if mood_text:
             # Use sentiment analysis on the text
             user_mood = sentiment_analyzer.analyze_sentiment(mood_text)
-            print(f"Analyzed mood text: '{mood_text}' -> {user_mood}")
+            logger.debug("Analyzed mood text: %r -> %s", mood_text, user_mood)
         elif not user_mood:
             return "Please select a mood or describe your mood.", 400
             
@@ -196,7 +428,7 @@ def generate_playlist():
         if not user_mood:
             return "Mood parameter missing.", 400
     
-    if user_mood not in ['happy', 'energetic', 'chill', 'sad', 'calm']:
+    if user_mood not in MOODS:
         return f"Invalid mood: {user_mood}", 400
     
     # Get tracks for the mood
@@ -205,154 +437,153 @@ def generate_playlist():
     if not tracks:
         return "Sorry, couldn't generate a playlist at this time. Please try again.", 500
     
-    # Check if this is an AJAX request (refresh)
-    if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
-        return render_template('playlist.html', mood=user_mood, tracks=tracks)
-    else:
-        return render_template('playlist.html', mood=user_mood, tracks=tracks)
+    # Full page loads and AJAX refreshes render the same template
+    return render_template('playlist.html', mood=user_mood, tracks=tracks)
+
+def is_popular(track, min_popularity):
+    """Check a track (which may be None in Spotify responses) against a popularity floor."""
+    return bool(track) and track.get('popularity', 0) > min_popularity
+
+def yield_recommendation_tracks(seed_ids, mood, min_popularity=60):
+    """Yield popular recommendations seeded from the user's top tracks."""
+    if not seed_ids:
+        return
+    
+    seed_combinations = [
+        seed_ids[:3],
+        seed_ids[3:6] if len(seed_ids) > 3 else seed_ids[:3],
+    ]
+    
+    # Add popularity constraint to features
+    popular_features = add_popularity_constraint(get_mood_features(mood))
+    
+    sp = get_spotify()
+    futures = [
+        submit_in_request_context(
+            sp.recommendations,
+            seed_tracks=seed_tracks[:3],
+            limit=20,
+            market='US',
+            **popular_features
+        )
+        for seed_tracks in seed_combinations
+    ]
+    
+    for future in futures:
+        # A failed call or malformed response only skips this batch
+        try:
+            recommendations = future.result()
+            tracks = [track for track in recommendations['tracks'] if is_popular(track, min_popularity)]
+        except Exception as e:
+            logger.warning("Error with recommendation API: %s", e)
+            continue
+        yield from tracks
+
+def yield_search_tracks(search_futures, min_popularity=40):
+    """Yield popular tracks from in-flight track searches, in query order."""
+    for search_query, future in search_futures.items():
+        try:
+            search_results = future.result()
+            tracks = [track for track in search_results['tracks']['items']
+                      if is_popular(track, min_popularity)] if search_results else []
+        except Exception as e:
+            logger.warning("Error with search query %r: %s", search_query, e)
+            continue
+        yield from tracks
 
-# Add these modifications to your main.py file
+def yield_playlist_tracks(mood, min_popularity=40):
+    """Yield popular tracks from popular playlists matching the mood."""
+    # Neither the playlist searches nor the playlist_tracks calls are made
+    # until this generator is reached
+    playlist_search_futures = {
+        query: submit_in_request_context(cached_search, q=query, type='playlist', limit=3)
+        for query in get_popular_playlist_queries(mood)
+    }
+    
+    playlist_track_futures = []
+    for query, future in playlist_search_futures.items():
+        try:
+            playlist_results = future.result()
+            playlist_ids = [playlist['id'] for playlist in playlist_results['playlists']['items']
+                            if playlist and playlist['tracks']['total'] > 0] if playlist_results else []
+        except Exception as e:
+            logger.warning("Error searching playlists for %r: %s", query, e)
+            continue
+        playlist_track_futures.extend(
+            submit_in_request_context(cached_playlist_tracks, playlist_id, limit=10)
+            for playlist_id in playlist_ids
+        )
+    
+    for future in playlist_track_futures:
+        try:
+            playlist_tracks = future.result()
+            tracks = [item['track'] for item in playlist_tracks['items']
+                      if item and is_popular(item['track'], min_popularity)] if playlist_tracks else []
+        except Exception as e:
+            logger.warning("Error getting popular playlist tracks: %s", e)
+            continue
+        yield from tracks
 
 def get_enhanced_tracks_for_mood(user_mood, avoid_recent=True):
     """Enhanced track generation with better variety and POPULAR tracks focus."""
     try:
-        print(f"Generating enhanced {user_mood} playlist with popular tracks...")
-        
-        cached_tracks = get_cached_tracks(user_mood) if avoid_recent else []
-        print(f"Found {len(cached_tracks)} cached tracks to avoid")
-        
-        all_tracks = []
-        
-        # Strategy 1: Popular tracks from user's top tracks
-        time_ranges = ['short_term', 'medium_term', 'long_term']
-        user_top_tracks = []
-        
-        for time_range in time_ranges:
-            try:
-                # Get more tracks and filter by popularity
-                top_tracks = sp.current_user_top_tracks(limit=25, time_range=time_range)
-                if top_tracks and top_tracks['items']:
-                    # Filter for popular tracks (popularity > 60)
-                    popular_tracks = [track['id'] for track in top_tracks['items'] 
-                                    if track.get('popularity', 0) > 60]
-                    user_top_tracks.extend(popular_tracks)
-            except Exception as e:
-                print(f"Error getting {time_range} top tracks: {e}")
+        logger.debug("Generating enhanced %s playlist with popular tracks...", user_mood)
+        
+        cached_tracks = get_cached_tracks(user_mood) if avoid_recent else frozenset()
+        logger.debug("Found %d cached tracks to avoid", len(cached_tracks))
+        
+        # The track searches are issued up front and run concurrently
+        
+        # Enhanced search with popular tracks focus
+        search_futures = {
+            search_query: submit_in_request_context(
+                cached_search,
+                q=search_query,
+                type='track',
+                limit=20,  # Get more results
+                market='US',
+                offset=0  # Start from top results (most popular)
+            )
+            for search_query in get_popular_search_strategies(user_mood)
+        }
         
-        user_top_tracks = list(set(user_top_tracks))
+        # Popular tracks from user's top tracks, fetched while the searches are
+        # in flight (it may update the session, so it is driven from the
+        # request thread)
+        user_top_tracks = get_user_top_track_ids()
         user_top_tracks = [tid for tid in user_top_tracks if tid not in cached_tracks]
         
-        # Strategy 2: Enhanced search with popular tracks focus
-        search_strategies = get_popular_search_strategies(user_mood)
-        
-        for search_query in search_strategies:
-            try:
-                # Search with popularity filters
-                search_results = sp.search(
-                    q=search_query,
-                    type='track',
-                    limit=20,  # Get more results
-                    market='US',
-                    offset=0  # Start from top results (most popular)
-                )
-                
-                if search_results and search_results['tracks']['items']:
-                    # Filter for high popularity tracks
-                    popular_tracks = [track for track in search_results['tracks']['items'] 
-                                    if track.get('popularity', 0) > 40 and track['id'] not in cached_tracks]
-                    all_tracks.extend(popular_tracks)
-                    
-            except Exception as e:
-                print(f"Error with search query '{search_query}': {e}")
-        
-        # Strategy 3: Get recommendations from popular seed tracks
-        if user_top_tracks:
-            seed_combinations = [
-                user_top_tracks[:3],
-                user_top_tracks[3:6] if len(user_top_tracks) > 3 else user_top_tracks[:3],
-            ]
-            
-            mood_features = get_mood_features(user_mood)
-            
-            for seed_tracks in seed_combinations:
-                if len(seed_tracks) >= 1:
-                    try:
-                        # Add popularity constraint to features
-                        popular_features = add_popularity_constraint(mood_features)
-                        
-                        recommendations = sp.recommendations(
-                            seed_tracks=seed_tracks[:3],
-                            limit=20,
-                            market='US',
-                            **popular_features
-                        )
-                        
-                        # Filter for popular recommendations
-                        popular_recs = [track for track in recommendations['tracks'] 
-                                      if track.get('popularity', 0) > 60 and track['id'] not in cached_tracks]
-                        all_tracks.extend(popular_recs)
-                        
-                    except Exception as e:
-                        print(f"Error with recommendation API: {e}")
-        
-        # Strategy 4: Popular playlists search
-        try:
-            playlist_queries = get_popular_playlist_queries(user_mood)
-            for query in playlist_queries:
-                playlist_results = sp.search(q=query, type='playlist', limit=3)
-                if playlist_results and playlist_results['playlists']['items']:
-                    for playlist in playlist_results['playlists']['items']:
-                        if playlist['tracks']['total'] > 0:
-                            playlist_tracks = sp.playlist_tracks(playlist['id'], limit=10)
-                            if playlist_tracks and playlist_tracks['items']:
-                                for item in playlist_tracks['items']:
-                                    if item['track'] and item['track'].get('popularity', 0) > 40:
-                                        if item['track']['id'] not in cached_tracks:
-                                            all_tracks.append(item['track'])
-        except Exception as e:
-            print(f"Error getting popular playlists: {e}")
+        # Pull candidates strategy by strategy, personalized ones first, and
+        # stop once there are enough; strategies not yet reached make no calls
+        candidates = chain(
+            yield_recommendation_tracks(user_top_tracks, user_mood),
+            yield_search_tracks(search_futures),
+            yield_playlist_tracks(user_mood),
+        )
         
-        # Remove duplicates and sort by popularity
         seen_ids = set()
         unique_tracks = []
-        
-        for track in all_tracks:
-            if track['id'] not in seen_ids:
-                seen_ids.add(track['id'])
-                unique_tracks.append(track)
-        
-        # Sort by popularity (highest first) with some randomness
-        unique_tracks.sort(key=lambda x: x.get('popularity', 0) + random.randint(-10, 10), reverse=True)
-        
-        # Take top tracks
-        selected_tracks = unique_tracks[:30]
-        
-        # Process tracks for display
-        processed_tracks = []
-        for track in selected_tracks:
-            try:
-                duration_ms = track.get('duration_ms', 0)
-                duration_min = duration_ms // 60000
-                duration_sec = (duration_ms % 60000) // 1000
-                
-                track_data = {
-                    'id': track['id'],
-                    'name': track['name'],
-                    'artist': track['artists'][0]['name'],
-                    'album': track['album']['name'],
-                    'url': track['external_urls']['spotify'],
-                    'mood': user_mood,
-                    'duration': f"{duration_min}:{duration_sec:02d}",
-                    'duration_ms': duration_ms,  # Fixed the error
-                    'popularity': track.get('popularity', 0),
-                    'explicit': track.get('explicit', False),
-                    'release_date': track['album'].get('release_date', 'Unknown'),
-                    'album_image': track['album']['images'][0]['url'] if track['album']['images'] else None
-                }
-                processed_tracks.append(track_data)
-            except Exception as e:
-                print(f"Error processing track: {e}")
+        for track in candidates:
+            if track['id'] in seen_ids or track['id'] in cached_tracks:
                 continue
+            seen_ids.add(track['id'])
+            unique_tracks.append(track)
+            if len(unique_tracks) >= CANDIDATE_POOL_SIZE:
+                break
+        
+        # Take the most popular tracks (highest first) with some randomness;
+        # the jitter is drawn in one call rather than one randint per track
+        jitter = random.choices(range(-10, 11), k=len(unique_tracks))
+        ranked = heapq.nlargest(
+            30, zip(jitter, unique_tracks), key=lambda pair: pair[1].get('popularity', 0) + pair[0]
+        )
+        selected_tracks = [track for _, track in ranked]
+        
+        # Process tracks for display, dropping any that are malformed
+        processed_tracks = [
+            track_data for track_data in (build_track_data(track, user_mood) for track in selected_tracks)
+            if track_data is not None
+        ]
         
         # Cache the track IDs
         track_ids = [track['id'] for track in processed_tracks]
@@ -361,9 +592,34 @@ def get_enhanced_tracks_for_mood(user_mood, avoid_recent=True):
         return processed_tracks[:20]
         
     except Exception as e:
-        print(f"Error in enhanced track generation: {e}")
+        logger.exception("Error in enhanced track generation: %s", e)
         return []
 
+def build_track_data(track, mood):
+    """Flatten a Spotify track object into the dict the playlist template uses, or None if malformed."""
+    try:
+        album = track['album']
+        duration_ms = track.get('duration_ms', 0)
+        duration_min, remainder_ms = divmod(duration_ms, 60000)
+        
+        return {
+            'id': track['id'],
+            'name': track['name'],
+            'artist': track['artists'][0]['name'],
+            'album': album['name'],
+            'url': track['external_urls']['spotify'],
+            'mood': mood,
+            'duration': f"{duration_min}:{remainder_ms // 1000:02d}",
+            'duration_ms': duration_ms,
+            'popularity': track.get('popularity', 0),
+            'explicit': track.get('explicit', False),
+            'release_date': album.get('release_date', 'Unknown'),
+            'album_image': next((image['url'] for image in album['images']), None)
+        }
+    except Exception as e:
+        logger.warning("Error processing track: %s", e)
+        return None
+
 def add_popularity_constraint(features):
     """Add popularity constraints to mood features."""
     popular_features = features.copy()
@@ -371,122 +627,126 @@ def add_popularity_constraint(features):
     popular_features['min_popularity'] = 40
     return popular_features
 
+# Track search queries per mood, focused on popular tracks
+POPULAR_SEARCH_STRATEGIES = {
+    'happy': (
+        'happy pop hits top charts dance party',
+        'feel good music billboard hot 100',
+        'uplifting pop rock mainstream hits',
+        'celebration party top songs 2024',
+        'sunny pop hits radio friendly'
+    ),
+    'energetic': (
+        'high energy workout hits gym music',
+        'pump up songs top charts rock metal',
+        'intense workout playlist billboard',
+        'adrenaline rush top hits electronic',
+        'motivation music popular tracks'
+    ),
+    'chill': (
+        'chill pop indie hits relaxing vibes',
+        'laid back hits mainstream chill',
+        'coffee shop music popular acoustic',
+        'sunday morning hits indie pop',
+        'chill vibes top tracks ambient'
+    ),
+    'sad': (
+        'sad pop hits emotional ballads',
+        'heartbreak songs top charts',
+        'emotional pop rock mainstream',
+        'melancholy hits indie sad songs',
+        'breakup songs popular emotional'
+    ),
+    'calm': (
+        'peaceful pop acoustic hits calm',
+        'meditation music popular relaxing',
+        'soft pop hits gentle acoustic',
+        'calming music mainstream peaceful',
+        'zen music popular ambient tracks'
+    )
+}
+
 def get_popular_search_strategies(mood):
     """Get search strategies focused on popular tracks."""
-    strategies = {
-        'happy': [
-            'happy pop hits top charts dance party',
-            'feel good music billboard hot 100',
-            'uplifting pop rock mainstream hits',
-            'celebration party top songs 2024',
-            'sunny pop hits radio friendly'
-        ],
-        'energetic': [
-            'high energy workout hits gym music',
-            'pump up songs top charts rock metal',
-            'intense workout playlist billboard',
-            'adrenaline rush top hits electronic',
-            'motivation music popular tracks'
-        ],
-        'chill': [
-            'chill pop indie hits relaxing vibes',
-            'laid back hits mainstream chill',
-            'coffee shop music popular acoustic',
-            'sunday morning hits indie pop',
-            'chill vibes top tracks ambient'
-        ],
-        'sad': [
-            'sad pop hits emotional ballads',
-            'heartbreak songs top charts',
-            'emotional pop rock mainstream',
-            'melancholy hits indie sad songs',
-            'breakup songs popular emotional'
-        ],
-        'calm': [
-            'peaceful pop acoustic hits calm',
-            'meditation music popular relaxing',
-            'soft pop hits gentle acoustic',
-            'calming music mainstream peaceful',
-            'zen music popular ambient tracks'
-        ]
-    }
-    
-    return strategies.get(mood, strategies['happy'])
+    return POPULAR_SEARCH_STRATEGIES.get(mood, POPULAR_SEARCH_STRATEGIES['happy'])
+
+# Playlist search queries per mood
+POPULAR_PLAYLIST_QUERIES = {
+    'happy': (
+        'Today\'s Top Hits happy',
+        'Pop Rising feel good',
+        'Mood Booster'
+    ),
+    'energetic': (
+        'Beast Mode workout',
+        'Power Hour gym',
+        'Adrenaline Workout'
+    ),
+    'chill': (
+        'Chill Hits',
+        'Indie Pop chill',
+        'Coffee House'
+    ),
+    'sad': (
+        'Sad Songs emotional',
+        'Heartbreak Pop',
+        'Life Sucks indie'
+    ),
+    'calm': (
+        'Peaceful Piano',
+        'Calm meditation',
+        'Acoustic Chill'
+    )
+}
 
 def get_popular_playlist_queries(mood):
     """Get popular playlist search queries for each mood."""
-    queries = {
-        'happy': [
-            'Today\'s Top Hits happy',
-            'Pop Rising feel good',
-            'Mood Booster'
-        ],
-        'energetic': [
-            'Beast Mode workout',
-            'Power Hour gym',
-            'Adrenaline Workout'
-        ],
-        'chill': [
-            'Chill Hits',
-            'Indie Pop chill',
-            'Coffee House'
-        ],
-        'sad': [
-            'Sad Songs emotional',
-            'Heartbreak Pop',
-            'Life Sucks indie'
-        ],
-        'calm': [
-            'Peaceful Piano',
-            'Calm meditation',
-            'Acoustic Chill'
-        ]
-    }
-    
-    return queries.get(mood, queries['happy'])
+    return POPULAR_PLAYLIST_QUERIES.get(mood, POPULAR_PLAYLIST_QUERIES['happy'])
+
+# Target audio features per mood, built once at import. The inner mappings are
+# read-only; callers take a .copy() before adjusting them.
+MOOD_FEATURES = {
+    'happy': MappingProxyType({
+        'target_valence': 0.8, 
+        'target_energy': 0.7, 
+        'target_danceability': 0.75,
+        'min_valence': 0.6,
+        'min_energy': 0.5
+    }),
+    'energetic': MappingProxyType({
+        'target_valence': 0.7, 
+        'target_energy': 0.9, 
+        'target_danceability': 0.8,
+        'min_energy': 0.7,
+        'min_danceability': 0.6
+    }),
+    'chill': MappingProxyType({
+        'target_valence': 0.5, 
+        'target_energy': 0.3, 
+        'target_acousticness': 0.6,
+        'max_energy': 0.5,
+        'min_acousticness': 0.3
+    }),
+    'sad': MappingProxyType({
+        'target_valence': 0.25, 
+        'target_energy': 0.3, 
+        'target_acousticness': 0.5,
+        'max_valence': 0.4,
+        'max_energy': 0.5
+    }),
+    'calm': MappingProxyType({
+        'target_valence': 0.4, 
+        'target_energy': 0.25, 
+        'min_tempo': 60, 
+        'max_tempo': 110,
+        'max_energy': 0.4,
+        'target_acousticness': 0.5
+    })
+}
 
 def get_mood_features(mood):
     """Get audio features for mood with some base randomization."""
-    base_features = {
-        'happy': {
-            'target_valence': 0.8, 
-            'target_energy': 0.7, 
-            'target_danceability': 0.75,
-            'min_valence': 0.6,
-            'min_energy': 0.5
-        },
-        'energetic': {
-            'target_valence': 0.7, 
-            'target_energy': 0.9, 
-            'target_danceability': 0.8,
-            'min_energy': 0.7,
-            'min_danceability': 0.6
-        },
-        'chill': {
-            'target_valence': 0.5, 
-            'target_energy': 0.3, 
-            'target_acousticness': 0.6,
-            'max_energy': 0.5,
-            'min_acousticness': 0.3
-        },
-        'sad': {
-            'target_valence': 0.25, 
-            'target_energy': 0.3, 
-            'target_acousticness': 0.5,
-            'max_valence': 0.4,
-            'max_energy': 0.5
-        },
-        'calm': {
-            'target_valence': 0.4, 
-            'target_energy': 0.25, 
-            'min_tempo': 60, 
-            'max_tempo': 110,
-            'max_energy': 0.4,
-            'target_acousticness': 0.5
-        }
-    }
-    
-    return base_features.get(mood, base_features['happy'])
+    return MOOD_FEATURES.get(mood, MOOD_FEATURES['happy'])
 
 def add_feature_variation(features):
     """Add slight randomization to features for variety."""
@@ -500,54 +760,10 @@ def add_feature_variation(features):
     
     return varied
 
-def get_search_strategies(mood):
-    """Get diverse search strategies for each mood."""
-    strategies = {
-        'happy': [
-            'happy pop upbeat dance party',
-            'feel good music positive vibes',
-            'uplifting songs cheerful',
-            'celebration joy music',
-            'sunny day driving songs'
-        ],
-        'energetic': [
-            'high energy workout music',
-            'rock metal electronic pump up',
-            'intense powerful songs',
-            'gym motivation music',
-            'adrenaline rush tracks'
-        ],
-        'chill': [
-            'indie alternative chill vibes',
-            'relaxed downtempo ambient',
-            'laid back acoustic mellow',
-            'sunday morning coffee music',
-            'dreamy atmospheric sounds'
-        ],
-        'sad': [
-            'sad emotional heartbreak songs',
-            'melancholy indie folk ballads',
-            'rainy day depression music',
-            'lonely contemplative tracks',
-            'slow emotional piano'
-        ],
-        'calm': [
-            'peaceful meditation ambient',
-            'soft acoustic folk gentle',
-            'nature sounds relaxation',
-            'spa yoga calming music',
-            'quiet evening piano instrumental'
-        ]
-    }
-    
-    return strategies.get(mood, strategies['happy'])
-
 @app.route('/create_spotify_playlist', methods=['POST'])
 def create_spotify_playlist():
     """Create an actual Spotify playlist from the generated tracks."""
-    token_info = cache_handler.get_cached_token()
-    
-    if not sp_oauth.validate_token(token_info):
+    if not get_valid_token():
         return jsonify({'error': 'Not authenticated'}), 401
     
     try:
@@ -558,9 +774,8 @@ def create_spotify_playlist():
         if not mood or not track_ids:
             return jsonify({'error': 'Missing mood or track_ids'}), 400
         
-        # Get current user info
-        user = sp.current_user()
-        user_id = user['id']
+        sp = get_spotify()
+        user_id = get_current_user_id()
         
         # Create playlist name with timestamp
         timestamp = datetime.now().strftime("%B %d, %Y at %I:%M %p")
@@ -576,8 +791,11 @@ def create_spotify_playlist():
         )
         
         # Add tracks to the playlist
+        # Spotify accepts at most 100 items per call; chunks are sent in order
+        # (not in parallel) so the playlist keeps the selected track order
         track_uris = [f"spotify:track:{track_id}" for track_id in track_ids]
-        sp.playlist_add_items(playlist['id'], track_uris)
+        for i in range(0, len(track_uris), 100):
+            sp.playlist_add_items(playlist['id'], track_uris[i:i + 100])
         
         return jsonify({
             'success': True,
@@ -586,7 +804,7 @@ def create_spotify_playlist():
         })
         
     except Exception as e:
-        print(f"Error creating playlist: {e}")
+        logger.exception("Error creating playlist: %s", e)
         return jsonify({'error': str(e)}), 500
 
 @app.route('/logout')
@@ -596,4 +814,6 @@ def logout():
     return redirect(url_for('home'))
 
 if __name__ == '__main__':
-    app.run(debug=True)
\ No newline at end of file
+    # Pick up template edits while developing locally
+    app.jinja_env.auto_reload = True
+    app.run(debug=os.getenv('FLASK_DEBUG') == '1')
\ No newline at end of file